@@ -1,10 +1,11 @@
 import cv2
+import json
 import time
 import threading
 import subprocess
 import shutil
 import numpy as np
-from flask import Flask, Response, jsonify, request
+from flask import Flask, Response, abort, jsonify, request
 from flask_cors import CORS
 from pymongo import MongoClient
 from bson.objectid import ObjectId
@@ -20,19 +21,219 @@ client = MongoClient(MONGO_URI)
 db = client.get_database("rtsp_db")
 overlays_collection = db.get_collection("overlays")
 
+try:
+    overlays_collection.create_index([('type', 1)])
+except Exception:
+    pass  # DB not reachable yet (e.g. container still starting); index is best-effort
+
+# Check for orjson availability (C json encoder, much faster than stdlib)
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    orjson = None
+    HAS_ORJSON = False
+
+
+def parse_json(req):
+    """Parses a request body with orjson (falls back to Flask's parser).
+
+    Malformed or empty bodies abort with a 400, matching the BadRequest
+    Flask's own request.json raised."""
+    if HAS_ORJSON:
+        try:
+            return orjson.loads(req.get_data(cache=False))
+        except orjson.JSONDecodeError:
+            abort(json_response({"error": "Invalid JSON body"}, 400))
+    return req.get_json()
+
+
+def json_response(obj, status=200):
+    """Builds a JSON response with orjson (falls back to jsonify)"""
+    if HAS_ORJSON:
+        return Response(orjson.dumps(obj), status=status, mimetype='application/json')
+    response = jsonify(obj)
+    response.status_code = status
+    return response
+
+# OpenCV's FFmpeg backend reads this once when a capture is constructed.
+# Set it exactly once at import (TCP transport to avoid smear artifacts,
+# capped decode buffer, 5 s socket timeout) instead of writing the
+# process-global environ from OpenCVCamera.__init__, which raced between
+# worker threads switching sources.
+os.environ.setdefault(
+    "OPENCV_FFMPEG_CAPTURE_OPTIONS",
+    "rtsp_transport;tcp|buffer_size;102400|stimeout;5000000"
+)
+
 # Check for FFmpeg availability
 FFMPEG_PATH = shutil.which('ffmpeg')
 HAS_FFMPEG = FFMPEG_PATH is not None
 
+# ffprobe (ships with FFmpeg): used for fast connection tests
+FFPROBE_PATH = shutil.which('ffprobe')
+HAS_FFPROBE = FFPROBE_PATH is not None
+
+# Check for TurboJPEG availability (libjpeg-turbo SIMD encoder)
+# 2-6x faster JPEG encode than OpenCV's bundled libjpeg on the hot path
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR, TJSAMP_420
+    _TJ = TurboJPEG()  # Thread-safe, reused across all streams
+    HAS_TURBOJPEG = True
+except Exception:
+    _TJ = None
+    HAS_TURBOJPEG = False
+
+# Check for CUDA-capable OpenCV (GPU JPEG encode via nvJPEG).
+# Requires an OpenCV build with CUDA codecs; stock opencv-python reports
+# zero devices and/or lacks cv2.cuda.imencode, so this stays False.
+HAS_CUDA_JPEG = False
+try:
+    if cv2.cuda.getCudaEnabledDeviceCount() > 0 and hasattr(cv2.cuda, 'imencode'):
+        HAS_CUDA_JPEG = True
+except Exception:
+    pass
+
+# Check for OpenCL (T-API): lets cv2.resize run on integrated GPUs via
+# UMat while the CPU keeps encoding
+HAS_OPENCL = False
+try:
+    if cv2.ocl.haveOpenCL():
+        cv2.ocl.setUseOpenCL(True)
+        HAS_OPENCL = cv2.ocl.useOpenCL()
+except Exception:
+    pass
+
+# Check for Numba availability (JIT-compiles the JPEG marker scanner)
+try:
+    from numba import njit
+    HAS_NUMBA = True
+except ImportError:
+    njit = None
+    HAS_NUMBA = False
+
 print(f"🖥️  System Check: FFmpeg is {'✅ INSTALLED' if HAS_FFMPEG else '❌ MISSING (Using OpenCV Fallback)'}")
+print(f"🖥️  System Check: TurboJPEG is {'✅ INSTALLED' if HAS_TURBOJPEG else '❌ MISSING (Using cv2.imencode Fallback)'}")
+
+
+def encode_jpeg(frame, quality=85):
+    """Encode a BGR frame to JPEG bytes (GPU > TurboJPEG > cv2.imencode)"""
+    if HAS_CUDA_JPEG:
+        try:
+            gpu = cv2.cuda_GpuMat()
+            gpu.upload(frame)
+            ret, buf = cv2.cuda.imencode('.jpg', gpu, [cv2.IMWRITE_JPEG_QUALITY, quality])
+            if ret:
+                return buf.tobytes()
+        except cv2.error:
+            pass  # GPU hiccup; fall through to the CPU encoders
+    if HAS_TURBOJPEG:
+        return _TJ.encode(frame, quality=quality, pixel_format=TJPF_BGR, jpeg_subsample=TJSAMP_420)
+    ret, jpeg = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ret:
+        return None
+    return jpeg.tobytes()
+
+
+def create_error_frame(message):
+    """Renders a black 640x480 frame with an error message"""
+    frame = np.zeros((480, 640, 3), dtype=np.uint8)
+    cv2.putText(frame, message, (120, 240), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
+    return frame
+
+
+# Rendered + encoded exactly once at import; the error path re-sends
+# these cached bytes instead of allocating and encoding per error
+_ERROR_JPEG = encode_jpeg(create_error_frame("NO SIGNAL"), quality=75)
+
+# Output frame-rate cap. Skipping happens inside the decoders (FFmpeg's
+# fps filter, or cheap grab()s on the OpenCV path) so dropped frames are
+# never fully decoded, let alone decoded-then-discarded in Python.
+STREAM_FPS = max(1, int(os.getenv("STREAM_FPS", "30")))
 
 # Global State
 app_config = {
     "source": 0,            # Current Source (0 or RTSP URL)
-    "camera_thread": None,  # The active background worker
     "lock": threading.Lock()
 }
 
+# Active broadcasters, one per source (guarded by app_config["lock"])
+_broadcasters = {}
+
+if HAS_NUMBA:
+    @njit(cache=True)
+    def _find_marker_jit(arr, marker_byte, start):
+        # Tight native loop over a uint8 view; LLVM auto-vectorizes the
+        # byte compare, and it stops at the first hit instead of building
+        # a full hit mask like the NumPy fallback below
+        for i in range(start, arr.shape[0] - 1):
+            if arr[i] == 0xFF and arr[i + 1] == marker_byte:
+                return i
+        return -1
+
+
+def _find_marker(buf, marker_byte, start):
+    """Vectorized scan for a JPEG marker (0xFF followed by marker_byte).
+
+    Numba-compiled when available, NumPy's SIMD-width C loops otherwise;
+    tails shorter than 64 bytes just use bytearray.find."""
+    if len(buf) - start < 64:
+        return buf.find(bytes((0xFF, marker_byte)), start)
+    view = np.frombuffer(memoryview(buf)[start:], dtype=np.uint8)
+    if HAS_NUMBA:
+        hit = _find_marker_jit(view, marker_byte, 0)
+        return -1 if hit == -1 else start + hit
+    hits = np.flatnonzero((view[:-1] == 0xFF) & (view[1:] == marker_byte))
+    if hits.size == 0:
+        return -1
+    return start + int(hits[0])
+
+
+class JPEGStreamParser:
+    """Incremental SOI/EOI parser over an MJPEG byte stream.
+
+    Feed raw chunks in, get complete JPEGs back. A mutable bytearray ring
+    buffer with a persistent scan cursor and cached SOI index keeps the
+    work O(N) per frame: extend() appends, a memoryview slices completed
+    frames out, and one 'del buf[:n]' memmove reclaims the prefix."""
+
+    def __init__(self, max_buf=10**7):
+        self._buf = bytearray()
+        self._scan_pos = 0   # First byte not yet examined
+        self._soi = -1       # Cached Start marker from a previous feed
+        self._max_buf = max_buf
+
+    def feed(self, chunk):
+        """Consumes one chunk; returns the JPEGs it completed (in order)"""
+        self._buf.extend(chunk)
+        frames = []
+
+        # Look for JPEG Start (0xFFD8) and End (0xFFD9)
+        # Resume from the cursor so already-scanned bytes aren't re-scanned
+        while True:
+            if self._soi == -1:
+                self._soi = _find_marker(self._buf, 0xD8, self._scan_pos)
+            b = _find_marker(self._buf, 0xD9, self._scan_pos)
+
+            if self._soi != -1 and b != -1:
+                if b > self._soi:
+                    frames.append(bytes(memoryview(self._buf)[self._soi:b+2]))
+                # else: garbage data (End byte appeared before Start), discard
+                del self._buf[:b+2]  # Single memmove of the tail
+                self._scan_pos = 0
+                self._soi = -1
+            else:
+                # No complete frame yet: a marker may straddle the chunk edge,
+                # so leave the last byte unexamined for the next pass
+                self._scan_pos = max(len(self._buf) - 1, 0)
+                if len(self._buf) > self._max_buf:
+                    # Safety: Clear buffer if no frame found (prevent memory leak)
+                    self._buf.clear()
+                    self._scan_pos = 0
+                    self._soi = -1
+                return frames
+
+
 # ==========================================
 # ENGINE 1: FFMPEG (High Performance RTSP)
 # ==========================================
@@ -40,24 +241,44 @@ class FFmpegCamera:
     def __init__(self, src):
         self.src = src
         self.stopped = False
-        self.frame = None
         self.status = False
-        
+
+        # Latest-frame slot: a (seq, jpeg_bytes) tuple replaced by a
+        # single reference store, which CPython makes atomic — consumers
+        # read it without ever taking a lock. The Condition below only
+        # wakes sleeping consumers; it never guards the data.
+        self._latest = (0, None)
+        self._cv = threading.Condition()
+
         # FFmpeg Command:
-        # -rtsp_transport tcp: Prevent gray/green smear artifacts
+        # -rtsp_transport tcp: Prevent gray/green smear artifacts (RTSP only)
+        # -f v4l2: Read webcams directly (int sources -> /dev/videoN)
         # -i src: Input
         # -f image2pipe: Output stream of images
         # -vcodec mjpeg: Encode as JPEG
-        # -s 1280x720: Resize to 720p (Massive speed boost vs 1080p)
+        # -vf fps=N,scale=1280:720: Cap frame rate inside the filter
+        #   graph (skipped frames are dropped before the encode) and
+        #   resize to 720p (Massive speed boost vs 1080p)
         # -q:v 5: Quality (Balance size/quality)
+        #
+        # FFmpeg hands us ready-to-send JPEGs, so Python never touches
+        # raw pixels: no decode, no re-encode, just a byte pass-through.
+        if isinstance(src, int):
+            input_args = ['-f', 'v4l2', '-framerate', '30', '-i', f'/dev/video{src}']
+        elif src.startswith("rtsp"):
+            input_args = ['-rtsp_transport', 'tcp', '-i', src]
+        else:
+            # http(s) streams, local files, etc.
+            input_args = ['-i', src]
+
         cmd = [
             FFMPEG_PATH,
             '-loglevel', 'error',
-            '-rtsp_transport', 'tcp',
-            '-i', src,
+            *input_args,
             '-f', 'image2pipe',
             '-vcodec', 'mjpeg',
-            '-s', '1280x720',
+            '-pix_fmt', 'yuvj420p',
+            '-vf', f'fps={STREAM_FPS},scale=1280:720',
             '-q:v', '5',
             '-'
         ]
@@ -77,42 +298,44 @@ class FFmpegCamera:
 
     def update(self):
         """Reads raw bytes from FFmpeg stdout and parses JPEGs"""
-        buffer = b""
+        parser = JPEGStreamParser()
         chunk_size = 4096
-        
+
         while not self.stopped:
             # Read chunk
             chunk = self.process.stdout.read(chunk_size)
             if not chunk:
                 self.status = False
                 break
-            
-            buffer += chunk
-            
-            # Look for JPEG Start (0xFFD8) and End (0xFFD9)
-            a = buffer.find(b'\xff\xd8')
-            b = buffer.find(b'\xff\xd9')
-            
-            if a != -1 and b != -1:
-                # FIX: Ensure End is after Start to avoid corruption
-                if b > a:
-                    jpg = buffer[a:b+2]
-                    buffer = buffer[b+2:] # Keep remaining bytes for next frame
-                    self.frame = jpg
-                    self.status = True
-                else:
-                    # Garbage data (End byte appeared before Start), discard it
-                    buffer = buffer[b+2:]
-                    
-            elif len(buffer) > 10**7:
-                 # Safety: Clear buffer if no frame found (prevent memory leak)
-                 buffer = b""
+
+            for jpg in parser.feed(chunk):
+                # Publish: one atomic tuple store (the bytes object is
+                # immutable, so the handoff is a pointer copy), then
+                # wake any sleeping consumers
+                self._latest = (self._latest[0] + 1, jpg)
+                self.status = True
+                with self._cv:
+                    self._cv.notify_all()
 
     def get_frame(self):
-        return self.frame
+        return self._latest[1]
+
+    def get_frame_blocking(self, last_seq, timeout=1.0):
+        """Waits for a frame newer than last_seq. Returns (seq, jpeg_bytes)."""
+        seq, jpg = self._latest  # Lock-free fast path
+        if seq != last_seq:
+            return (seq, jpg)
+        with self._cv:
+            self._cv.wait_for(lambda: self._latest[0] != last_seq or self.stopped, timeout=timeout)
+        seq, jpg = self._latest
+        if seq == last_seq:
+            return (last_seq, None)  # Timed out / stopped
+        return (seq, jpg)
 
     def stop(self):
         self.stopped = True
+        with self._cv:
+            self._cv.notify_all()
         if self.process:
             self.process.terminate()
             try:
@@ -126,17 +349,73 @@ class FFmpegCamera:
 class OpenCVCamera:
     def __init__(self, src=0):
         self.src = src
-        
-        # Force TCP if it's an RTSP stream (OpenCV backend)
-        if isinstance(src, str) and src.startswith("rtsp"):
-            os.environ["OPENCV_FFMPEG_CAPTURE_OPTIONS"] = "rtsp_transport;tcp"
-            
-        self.capture = cv2.VideoCapture(src)
+
+        # Pin the backend explicitly: FFmpeg for network streams (picks
+        # up OPENCV_FFMPEG_CAPTURE_OPTIONS set at import), OS default for
+        # webcam indices. Keeps engine choice deterministic.
+        if isinstance(src, str):
+            self.capture = cv2.VideoCapture(src, cv2.CAP_FFMPEG)
+        else:
+            self.capture = cv2.VideoCapture(src)
         self.capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
 
-        self.status, self.frame = self.capture.read()
+        # FAST PATH (webcams): most webcams can emit MJPEG directly.
+        # Grab the raw JPEG bytes instead of decoded BGR, then TurboJPEG
+        # fuses the 720p downscale into the decode (1/2, 1/4... scaling
+        # is nearly free) — one memory pass instead of resize + encode.
+        self._raw_jpeg = False
+        if HAS_TURBOJPEG and isinstance(src, int):
+            self.capture.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
+            self.capture.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+            ok, probe = self.capture.read()
+            if ok and probe is not None and probe.reshape(-1)[:2].tobytes() == b'\xff\xd8':
+                self._raw_jpeg = True
+                print("📷 Webcam raw MJPEG passthrough enabled (TurboJPEG scale-on-decode)")
+            else:
+                # Driver ignored the request; back to normal BGR frames
+                self.capture.set(cv2.CAP_PROP_CONVERT_RGB, 1)
+
+        # SECOND-BEST PATH: planar YUV420 straight from the camera. JPEG
+        # is YCbCr internally, so encoding from YUV skips the BGR->YCbCr
+        # conversion pass and moves 1.5 bytes/px instead of 3.
+        self._yuv_native = False
+        if HAS_TURBOJPEG and isinstance(src, int) and not self._raw_jpeg:
+            self.capture.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'I420'))
+            self.capture.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+            width = int(self.capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+            height = int(self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            ok, probe = self.capture.read()
+            # A planar YUV420 buffer is exactly w*h*3/2 bytes. Only take
+            # this path at <= 720p: encode_from_yuv can't downscale, so a
+            # larger source must go through the resize pipeline below to
+            # keep the 720p output cap every other path enforces.
+            if (ok and probe is not None and height <= 720
+                    and probe.size == width * height * 3 // 2):
+                self._yuv_native = True
+                self._yuv_size = (width, height)
+                print("📷 Webcam native YUV420 capture enabled (no BGR conversion)")
+            else:
+                self.capture.set(cv2.CAP_PROP_CONVERT_RGB, 1)
+
+        self.status, first_frame = self.capture.read()
         self.stopped = False
-        
+
+        # Resize target, computed from the first frame and then reused:
+        # the source resolution is fixed in steady state, so there is no
+        # need to redo the shape lookup + aspect arithmetic per frame.
+        # None means the source is already <= 720p (no resize at all).
+        self._resize_target = None
+        self._resize_known = False
+
+        # Frame-rate cap for a nominal 30 fps source: grab() the frames
+        # we intend to drop — much cheaper than a full retrieve() decode
+        self._grabs_per_frame = max(1, 30 // STREAM_FPS)
+
+        # Latest-frame slot (same lock-free contract as FFmpegCamera),
+        # holding the raw capture output rather than encoded JPEG
+        self._latest = (0, first_frame)
+        self._cv = threading.Condition()
+
         self.thread = threading.Thread(target=self.update, args=())
         self.thread.daemon = True
         self.thread.start()
@@ -144,12 +423,17 @@ class OpenCVCamera:
     def update(self):
         while not self.stopped:
             if self.capture.isOpened():
-                # Grab to clear buffer
-                self.capture.grab()
+                # Grab to clear buffer; extra grabs implement the frame
+                # skip without paying for a decode per dropped frame
+                for _ in range(self._grabs_per_frame):
+                    self.capture.grab()
                 status, frame = self.capture.retrieve()
                 if status:
-                    self.frame = frame
+                    # One atomic tuple store, then wake sleeping consumers
+                    self._latest = (self._latest[0] + 1, frame)
                     self.status = True
+                    with self._cv:
+                        self._cv.notify_all()
                 else:
                     self.status = False
                     time.sleep(0.1)
@@ -157,59 +441,166 @@ class OpenCVCamera:
                 time.sleep(0.1)
 
     def get_frame(self):
-        if not self.status or self.frame is None:
+        # Snapshot the slot once: every use below sees the same frame
+        # even if the capture thread publishes a newer one mid-encode
+        frame = self._latest[1]
+        if not self.status or frame is None:
             return None
-        
+
+        if self._raw_jpeg:
+            # Camera already handed us a JPEG: no cv2.resize, no encode.
+            # If it's above 720p, re-scale inside the codec instead.
+            jpeg_bytes = frame.tobytes()
+            try:
+                width, height, _, _ = _TJ.decode_header(jpeg_bytes)
+            except Exception:
+                return None  # Corrupt frame, skip it
+            if height > 2880:
+                return _TJ.scale_with_quality(jpeg_bytes, scaling_factor=(1, 8), quality=85)
+            if height > 1440:
+                return _TJ.scale_with_quality(jpeg_bytes, scaling_factor=(1, 4), quality=85)
+            if height > 720:
+                return _TJ.scale_with_quality(jpeg_bytes, scaling_factor=(1, 2), quality=85)
+            return jpeg_bytes
+
+        if self._yuv_native:
+            # Encode straight from the planar YUV buffer: the colorspace
+            # conversion stage inside the JPEG encoder disappears
+            width, height = self._yuv_size
+            try:
+                return _TJ.encode_from_yuv(frame.tobytes(), height, width,
+                                           quality=85, jpeg_subsample=TJSAMP_420)
+            except Exception:
+                return None  # Corrupt frame, skip it
+
         # Resize to 720p (Performance optimization)
-        h, w = self.frame.shape[:2]
-        if h > 720:
-            aspect_ratio = w / h
-            new_w = int(720 * aspect_ratio)
-            resized = cv2.resize(self.frame, (new_w, 720), interpolation=cv2.INTER_AREA)
+        if not self._resize_known:
+            h, w = frame.shape[:2]
+            if h > 720:
+                self._resize_target = (int(720 * w / h), 720)
+            self._resize_known = True
+
+        if self._resize_target is not None:
+            if HAS_OPENCL:
+                # UMat dispatches the resize to the iGPU (OpenCL T-API);
+                # .get() downloads the 720p result for the CPU encoder
+                u = cv2.resize(cv2.UMat(frame), self._resize_target, interpolation=cv2.INTER_AREA)
+                resized = u.get()
+            else:
+                resized = cv2.resize(frame, self._resize_target, interpolation=cv2.INTER_AREA)
         else:
-            resized = self.frame
+            resized = frame
             
-        ret, jpeg = cv2.imencode('.jpg', resized, [cv2.IMWRITE_JPEG_QUALITY, 85])
-        return jpeg.tobytes()
+        return encode_jpeg(resized, quality=85)
+
+    def get_frame_blocking(self, last_seq, timeout=1.0):
+        """Waits for a frame newer than last_seq. Returns (seq, jpeg_bytes)."""
+        seq = self._latest[0]  # Lock-free fast path
+        if seq == last_seq:
+            with self._cv:
+                self._cv.wait_for(lambda: self._latest[0] != last_seq or self.stopped, timeout=timeout)
+            seq = self._latest[0]
+            if seq == last_seq:
+                return (last_seq, None)  # Timed out / stopped
+        # Encode without holding any lock; the capture thread never blocks
+        return (seq, self.get_frame())
 
     def stop(self):
         self.stopped = True
+        with self._cv:
+            self._cv.notify_all()
         if self.capture.isOpened():
             self.capture.release()
 
-# --- STREAM GENERATOR ---
-def generate_frames():
-    # Initialize the camera thread if needed
-    if app_config["camera_thread"] is None:
-        src = app_config["source"]
-        
+# ==========================================
+# BROADCASTER: 1 Producer -> N Clients
+# ==========================================
+class FrameBroadcaster:
+    """Owns one capture engine and fans its frames out to every client.
+
+    N concurrent /video_feed clients cost ~1x capture+encode instead of Nx:
+    each client just waits on the engine's new-frame Condition and reads
+    the shared (immutable) JPEG bytes."""
+    def __init__(self, source):
+        self.source = source
+        self.refcount = 0  # Guarded by app_config["lock"]
+
         # LOGIC: Choose Engine
-        use_ffmpeg = False
-        if HAS_FFMPEG and isinstance(src, str) and src.startswith("rtsp"):
-            use_ffmpeg = True
-            
-        print(f"📷 Starting Source: {src} | Engine: {'FFMPEG' if use_ffmpeg else 'OPENCV'}")
-        
+        # Prefer FFmpeg for everything (webcams via v4l2, rtsp/http/files);
+        # OpenCV is the last-resort fallback when FFmpeg is missing.
+        use_ffmpeg = HAS_FFMPEG
+        print(f"📷 Starting Source: {source} | Engine: {'FFMPEG' if use_ffmpeg else 'OPENCV'}")
+
         if use_ffmpeg:
-            app_config["camera_thread"] = FFmpegCamera(src)
+            self.camera = FFmpegCamera(source)
         else:
-            app_config["camera_thread"] = OpenCVCamera(src)
-            
-        time.sleep(1) # Warmup
+            self.camera = OpenCVCamera(source)
 
-    camera = app_config["camera_thread"]
+    def get_frame_blocking(self, last_seq, timeout=1.0):
+        return self.camera.get_frame_blocking(last_seq, timeout)
 
-    while True:
-        frame_bytes = camera.get_frame()
-        
-        if frame_bytes is None:
-            time.sleep(0.1)
-            continue
+    def stop(self):
+        self.camera.stop()
 
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
-        
-        time.sleep(0.03) # Cap at ~30 FPS
+
+def acquire_broadcaster(source):
+    """Gets (or starts) the shared broadcaster for a source and refcounts it"""
+    with app_config["lock"]:
+        broadcaster = _broadcasters.get(source)
+        if broadcaster is None:
+            broadcaster = FrameBroadcaster(source)
+            _broadcasters[source] = broadcaster
+        broadcaster.refcount += 1
+        return broadcaster
+
+
+def release_broadcaster(broadcaster):
+    """Drops one client; stops the engine when the last client leaves"""
+    with app_config["lock"]:
+        broadcaster.refcount -= 1
+        if broadcaster.refcount <= 0:
+            if _broadcasters.get(broadcaster.source) is broadcaster:
+                del _broadcasters[broadcaster.source]
+            broadcaster.stop()
+
+
+# --- STREAM GENERATOR ---
+
+# Multipart framing, prebuilt once. Yielding one bytes object per frame
+# (instead of several small ones) means one send() per frame, and
+# Content-Length lets clients slice the JPEG without boundary scanning.
+_PART_PREFIX = b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: '
+_PART_SEP = b'\r\n\r\n'
+_PART_END = b'\r\n'
+
+
+def _multipart_chunk(jpeg_bytes):
+    # join() of known-length pieces sizes the result once and does a
+    # single memcpy pass; '+' would allocate an intermediate per operand
+    return b''.join((_PART_PREFIX, b'%d' % len(jpeg_bytes), _PART_SEP, jpeg_bytes, _PART_END))
+
+
+def generate_frames():
+    broadcaster = acquire_broadcaster(app_config["source"])
+
+    try:
+        # Event-driven loop: block until the capture thread publishes a new
+        # frame instead of sleeping a fixed 30 ms (which added latency and
+        # could re-send the same frame)
+        last_seq = 0
+        while True:
+            last_seq, frame_bytes = broadcaster.get_frame_blocking(last_seq)
+
+            if frame_bytes is None:
+                # Source stalled: show the cached error card (zero encode
+                # cost) instead of freezing on the last good frame
+                yield _multipart_chunk(_ERROR_JPEG)
+                continue
+
+            yield _multipart_chunk(frame_bytes)
+    finally:
+        # Client disconnected
+        release_broadcaster(broadcaster)
 
 # --- ROUTES ---
 
@@ -217,16 +608,73 @@ def generate_frames():
 def video_feed():
     return Response(generate_frames(), mimetype='multipart/x-mixed-replace; boundary=frame')
 
+@app.route('/video_feed.mp4')
+def video_feed_mp4():
+    """Fragmented-MP4 stream for MSE <video> clients.
+
+    For RTSP/http sources FFmpeg re-muxes the H.264 packets (-c:v copy)
+    with NO re-encoding: Python only shuttles ~KB-sized packets instead
+    of ~100 KB JPEGs, and the browser decodes on its own GPU. The MJPEG
+    /video_feed route stays as the legacy fallback."""
+    if not HAS_FFMPEG:
+        return json_response({"error": "FFmpeg is not installed"}, 503)
+
+    src = app_config["source"]
+
+    if isinstance(src, int):
+        # Webcams emit raw frames, so they need a real (fast) encode
+        input_args = ['-f', 'v4l2', '-framerate', '30', '-i', f'/dev/video{src}']
+        codec_args = ['-c:v', 'libx264', '-preset', 'ultrafast', '-tune', 'zerolatency']
+    elif src.startswith("rtsp"):
+        input_args = ['-rtsp_transport', 'tcp', '-i', src]
+        codec_args = ['-c:v', 'copy']
+    else:
+        input_args = ['-i', src]
+        codec_args = ['-c:v', 'copy']
+
+    cmd = [
+        FFMPEG_PATH,
+        '-loglevel', 'error',
+        *input_args,
+        *codec_args,
+        '-an',
+        '-f', 'mp4',
+        '-movflags', '+empty_moov+default_base_moof+frag_keyframe',
+        '-'
+    ]
+
+    print(f"🚀 Starting MP4 Remux Pipe: {' '.join(cmd)}")
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=10**7)
+
+    def stream():
+        try:
+            while True:
+                chunk = process.stdout.read(65536)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            # Client disconnected
+            process.terminate()
+            try:
+                process.wait(timeout=1)
+            except:
+                process.kill()
+
+    return Response(stream(), mimetype='video/mp4')
+
 @app.route('/settings', methods=['GET'])
 def get_settings():
-    return jsonify({
+    with app_config["lock"]:
+        active = sum(b.refcount for b in _broadcasters.values())
+    return json_response({
         "current_source": app_config["source"],
-        "active_streams": 1 if app_config["camera_thread"] else 0
+        "active_streams": active
     })
 
 @app.route('/settings', methods=['POST'])
 def update_settings():
-    data = request.json
+    data = parse_json(request)
     new_source = data.get('rtsp_url', '').strip()
     
     # Determine new source
@@ -234,62 +682,91 @@ def update_settings():
     if new_source and new_source != "0":
         target = new_source
 
-    # Stop old thread
-    if app_config["camera_thread"]:
-        app_config["camera_thread"].stop()
-        app_config["camera_thread"] = None
-    
-    # Update state (Generator will restart thread on next request)
-    app_config["source"] = target
-    
-    return jsonify({"message": f"Source switched to {target}", "current_source": target})
+    # Swap the source atomically; drop the old broadcaster from the
+    # registry so new clients start fresh. Clients still attached to the
+    # old source keep it alive until they disconnect (refcount -> 0).
+    with app_config["lock"]:
+        old = _broadcasters.pop(app_config["source"], None)
+        app_config["source"] = target
+
+    if old is not None and old.refcount <= 0:
+        old.stop()
+
+    return json_response({"message": f"Source switched to {target}", "current_source": target})
 
 @app.route('/test_connection', methods=['POST'])
 def test_connection():
-    # Quick connectivity check using OpenCV (FFmpeg is too heavy for a quick test)
-    data = request.json
+    data = parse_json(request)
     src = data.get('rtsp_url', 0)
     if src == "0": src = 0
-    
+
+    # Metadata-only handshake via ffprobe: cv2.VideoCapture does a full
+    # codec probe + first-frame decode and can hang 30+ s on a dead RTSP
+    # URL, while ffprobe just reads the stream header with a 2 s timeout
+    if HAS_FFPROBE and isinstance(src, str):
+        cmd = [FFPROBE_PATH, '-v', 'error']
+        if src.startswith('rtsp'):
+            cmd += ['-rtsp_transport', 'tcp', '-timeout', '2000000']
+        cmd += ['-select_streams', 'v:0',
+                '-show_entries', 'stream=codec_name,width,height',
+                '-of', 'json', src]
+        try:
+            result = subprocess.run(cmd, capture_output=True, timeout=5)
+        except subprocess.TimeoutExpired:
+            return json_response({"success": False, "message": "Connection Timed Out"})
+        if result.returncode == 0:
+            info = orjson.loads(result.stdout) if HAS_ORJSON else json.loads(result.stdout)
+            if info.get('streams'):
+                return json_response({"success": True, "message": "Connection OK"})
+        return json_response({"success": False, "message": "Connection Failed"})
+
+    # Fallback (webcam indices, or ffprobe missing): quick OpenCV check
     cap = cv2.VideoCapture(src)
     if cap.isOpened():
         ret, _ = cap.read()
         cap.release()
-        if ret: return jsonify({"success": True, "message": "Connection OK"})
-    return jsonify({"success": False, "message": "Connection Failed"})
+        if ret: return json_response({"success": True, "message": "Connection OK"})
+    return json_response({"success": False, "message": "Connection Failed"})
 
 # --- CRUD (UNCHANGED) ---
 @app.route('/overlays', methods=['GET'])
 def get_overlays():
-    overlays = []
-    for doc in overlays_collection.find():
-        doc['_id'] = str(doc['_id'])
-        overlays.append(doc)
-    return jsonify(overlays)
+    # Single comprehension over a batched cursor: pymongo streams 500-doc
+    # batches and we do one inline str(ObjectId) per doc instead of the
+    # old append-and-mutate loop
+    overlays = [{**doc, '_id': str(doc['_id'])}
+                for doc in overlays_collection.find(batch_size=500)]
+    return json_response(overlays)
 
 @app.route('/overlays', methods=['POST'])
 def create_overlay():
-    data = request.json
+    data = parse_json(request)
     res = overlays_collection.insert_one(data)
     data['_id'] = str(res.inserted_id)
-    return jsonify(data), 201
+    return json_response(data, 201)
 
 @app.route('/overlays/<id>', methods=['PUT'])
 def update_overlay(id):
-    overlays_collection.update_one({"_id": ObjectId(id)}, {"$set": request.json})
-    return jsonify({"msg": "ok"})
+    overlays_collection.update_one({"_id": ObjectId(id)}, {"$set": parse_json(request)})
+    return json_response({"msg": "ok"})
 
 @app.route('/overlays/<id>', methods=['DELETE'])
 def delete_overlay(id):
     overlays_collection.delete_one({"_id": ObjectId(id)})
-    return jsonify({"msg": "ok"})
+    return json_response({"msg": "ok"})
 
 # Cleanup
 def cleanup():
-    if app_config["camera_thread"]:
-        app_config["camera_thread"].stop()
+    with app_config["lock"]:
+        broadcasters = list(_broadcasters.values())
+        _broadcasters.clear()
+    for broadcaster in broadcasters:
+        broadcaster.stop()
 atexit.register(cleanup)
 
 if __name__ == '__main__':
+    # Dev-only entrypoint. Production runs under gunicorn (see
+    # gunicorn.conf.py / Dockerfile); Werkzeug's dev server is a single
+    # GIL-bound process and each video stream pins one of its threads.
     # host='0.0.0.0' exposes the server to the Docker network
-    app.run(host='0.0.0.0', debug=True, port=5000, threaded=True)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=5000, threaded=True)
\ No newline at end of file
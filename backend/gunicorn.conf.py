@@ -0,0 +1,19 @@
+# Gunicorn config for the streaming backend.
+#
+# gthread worker: each multipart video stream permanently occupies one
+# thread, so we give the worker a generous thread pool instead of
+# Werkzeug's tiny dev-server pool.
+bind = "0.0.0.0:5000"
+worker_class = "gthread"
+workers = 1
+threads = 16
+timeout = 0       # Streams are long-lived; never kill a worker for "hanging"
+keepalive = 75
+
+# NOTE: workers MUST stay at 1 until source/broadcaster state moves to
+# shared storage. app_config["source"] and the _broadcasters registry are
+# per-process, so with N workers a POST /settings would switch the source
+# in only one of them, GET /settings would report per-worker counts, and
+# every worker would try to open its own capture (a v4l2 webcam can only
+# be held by one process). The concurrency win over Werkzeug comes from
+# the 16 threads, not from extra processes.
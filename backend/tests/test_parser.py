@@ -0,0 +1,93 @@
+import unittest
+import sys
+import os
+
+# --- THE FIX: Add the parent directory to the system path ---
+# This tells Python: "Look one folder up from where this file is."
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# ------------------------------------------------------------
+
+from app import JPEGStreamParser, _find_marker
+
+
+def jpeg(payload):
+    """Builds a fake JPEG: SOI marker + payload + EOI marker"""
+    return b'\xff\xd8' + payload + b'\xff\xd9'
+
+
+class FindMarkerTests(unittest.TestCase):
+    def test_short_tail_uses_find(self):
+        """Buffers under 64 bytes take the bytearray.find path"""
+        buf = bytearray(b'ab\xff\xd8c')
+        self.assertEqual(_find_marker(buf, 0xD8, 0), 2)
+
+    def test_long_buffer(self):
+        """Buffers over 64 bytes take the vectorized path"""
+        buf = bytearray(b'\x00' * 100 + b'\xff\xd8' + b'\x11' * 500 + b'\xff\xd9')
+        self.assertEqual(_find_marker(buf, 0xD8, 0), 100)
+        self.assertEqual(_find_marker(buf, 0xD9, 0), 602)
+
+    def test_respects_start_offset(self):
+        buf = bytearray(b'\xff\xd8' + b'\x00' * 200 + b'\xff\xd8')
+        self.assertEqual(_find_marker(buf, 0xD8, 1), 202)
+
+    def test_missing_marker(self):
+        self.assertEqual(_find_marker(bytearray(b'\x00' * 300), 0xD9, 0), -1)
+
+    def test_matches_bytearray_find(self):
+        """The vectorized path must agree with a plain scan"""
+        buf = bytearray(b'\xfa\xff\xd9\x00' * 64)
+        self.assertEqual(_find_marker(buf, 0xD9, 0), buf.find(b'\xff\xd9'))
+
+
+class JPEGStreamParserTests(unittest.TestCase):
+    def parse(self, data, chunk_size):
+        """Feeds data through a fresh parser in fixed-size chunks"""
+        parser = JPEGStreamParser()
+        frames = []
+        for i in range(0, len(data), chunk_size):
+            frames.extend(parser.feed(data[i:i + chunk_size]))
+        return frames
+
+    def test_single_frame(self):
+        frame = jpeg(b'A' * 5000)
+        self.assertEqual(self.parse(frame, 4096), [frame])
+
+    def test_multiple_frames_in_one_chunk(self):
+        frames = [jpeg(b'A' * 100), jpeg(b'B' * 200), jpeg(b'C' * 50)]
+        self.assertEqual(self.parse(b''.join(frames), 10**6), frames)
+
+    def test_markers_straddle_chunk_boundaries(self):
+        """Every chunk size, down to single bytes, must split some marker"""
+        frames = [jpeg(b'A' * 333), jpeg(b'B' * 777)]
+        data = b''.join(frames)
+        for chunk_size in (1, 2, 3, 7, 333, 4096):
+            self.assertEqual(self.parse(data, chunk_size), frames, chunk_size)
+
+    def test_leading_garbage_is_skipped(self):
+        frame = jpeg(b'A' * 100)
+        self.assertEqual(self.parse(b'\x00garbage\x00' + frame, 4096), [frame])
+
+    def test_eoi_before_soi_garbage_discarded(self):
+        """A stray EOI before the first SOI must not produce a frame"""
+        frame = jpeg(b'A' * 100)
+        data = b'\x00\x00\xff\xd9\x00' + frame
+        for chunk_size in (1, 5, 4096):
+            self.assertEqual(self.parse(data, chunk_size), [frame], chunk_size)
+
+    def test_interleaved_junk_between_frames(self):
+        f1, f2 = jpeg(b'A' * 64), jpeg(b'B' * 64)
+        self.assertEqual(self.parse(f1 + b'\x00junk\x00' + f2, 16), [f1, f2])
+
+    def test_overflow_resets_and_recovers(self):
+        parser = JPEGStreamParser(max_buf=1024)
+        # Marker-free data beyond the cap must be dropped...
+        self.assertEqual(parser.feed(b'\x00' * 2048), [])
+        self.assertEqual(len(parser._buf), 0)
+        # ...and the parser must still pick up the next clean frame
+        frame = jpeg(b'B' * 64)
+        self.assertEqual(parser.feed(frame), [frame])
+
+
+if __name__ == "__main__":
+    unittest.main()